@@ -52,13 +52,72 @@ block=...
 
 """
 
-from __future__ import print_function
-
+import argparse
+import os
 import re
-try:
-    import configparser
-except ImportError:
-    import ConfigParser as configparser
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+
+DEFAULT_ENCODING = "utf-8"
+
+_INI_SECTION_RE = re.compile(r"^\[([^\]]+)\]\s*$")
+_INI_VALUE_RE = re.compile(r"^([^=:\s][^=:]*?)\s*[=:]\s*(.*)$")
+_FALSY = frozenset(("0", "false", "no", "off"))
+_INLINE_FLAGS_RE = re.compile(r"^(?:\(\?[aiLmsux]+\))*")
+
+
+def _parse_ini(filename):
+    """ Parse an INI file into an ordered mapping of section names to a list
+    of (key, value) items.  Repeated keys are kept in order, and lines
+    indented further than a key continue its value. """
+
+    sections = OrderedDict()
+    items = None
+    key_indent = None
+    blanks = 0
+
+    with open(filename) as handle:
+        for (lineno, line) in enumerate(handle, 1):
+            stripped = line.strip()
+
+            if not stripped:
+                blanks += 1
+                continue
+
+            if stripped[0] in "#;":
+                continue
+
+            indent = len(line) - len(line.lstrip())
+            if key_indent is not None and indent > key_indent:
+                # Continuation of the previous value
+                (key, value) = items[-1]
+                items[-1] = (key, value + "\n" * (blanks + 1) + stripped)
+                blanks = 0
+                continue
+
+            blanks = 0
+            match = _INI_SECTION_RE.match(stripped)
+            if match:
+                if match.group(1) == "DEFAULT":
+                    # configparser would merge these into every section, which
+                    # attribute sections would reject as unknown keys anyway
+                    raise ValueError("{0}:{1}: DEFAULT section is not supported".format(filename, lineno))
+
+                items = sections.setdefault(match.group(1), [])
+                key_indent = None
+                continue
+
+            match = _INI_VALUE_RE.match(stripped)
+            if match and items is not None:
+                items.append((match.group(1).lower(), match.group(2)))
+                key_indent = indent
+                continue
+
+            raise ValueError("{0}:{1}: Invalid line: {2}".format(filename, lineno, stripped))
+
+    return sections
 
 
 class IniAttribute(object):
@@ -83,11 +142,8 @@ class IniListAttribute(IniAttribute):
         self._value = []
 
     def set(self, value):
-        self._value.extend(
-            i.strip()
-            for i in value.split(self._sep)
-            if i.strip()
-        )
+        # Strip and drop empty items without a Python-level loop
+        self._value.extend(filter(None, map(str.strip, value.split(self._sep))))
 
     def get(self):
         return list(self._value)
@@ -100,16 +156,18 @@ class IniValueAttribute(IniAttribute):
         self._value = defval
 
     def set(self, value):
-        self._value = value
+        # Strip surrounding quotes once here instead of on every get
+        if isinstance(value, str) and len(value) >= 2 and value[0] == '"' and value[-1] == '"':
+            value = value[1:-1]
 
-    def get(self):
-        value = self._value
+        self._value = value
 
-        if isinstance(value, str):
-            if value.startswith('"') and value.endswith('"'):
-                return value[1:-1]
+class IniIntAttribute(IniValueAttribute):
+    """ An INI value attribute converted to an integer when set. """
 
-        return value
+    def set(self, value):
+        IniValueAttribute.set(self, value)
+        self._value = int(self._value)
 
 class IniBoolAttribute(IniAttribute):
     """ Bool attribute. """
@@ -119,15 +177,26 @@ class IniBoolAttribute(IniAttribute):
         self._value = defval
 
     def set(self, value):
-        bval = value.strip().lower() not in ("0", "false", "no", "off")
-        self._value = bval
+        self._value = value.strip().lower() not in _FALSY
 
 class IniAttributeSection(object):
 
+    def __init__(self):
+        self._attr_map = {}
+
+    def _init_attr_map(self):
+        """ Map attribute names to the IniAttributes of this section.  Called
+        at the end of subclass __init__ once all attributes are defined. """
+        self._attr_map = {
+            name: value
+            for (name, value) in vars(self).items()
+            if isinstance(value, IniAttribute)
+        }
+
     def update(self, section):
+        attr_map = self._attr_map
         for (key, value) in section:
-            aname = "{0}".format(key.replace("-", "_"))
-            attr = getattr(self, aname, None)
+            attr = attr_map.get(key.replace("-", "_"))
 
             if attr:
                 attr.set(value)
@@ -149,15 +218,69 @@ class IniSection(object):
             
             self._results[key].set(value)
 
+    def get(self, key, default=None):
+        if key in self._results:
+            return self._results[key].get()
+        return default
+
     def items(self):
-        return list((i, j()) for (i, j) in self._results.items())
+        return list((i, j.get()) for (i, j) in self._results.items())
 
 class DumpMixin(object):
     def dump(self):
-        for i in sorted(dir(self)):
-            v = getattr(self, i)
-            if isinstance(v, IniAttribute):
-                print("Value: {0}={1}".format(i, repr(v.get())))
+        attr_map = self._attr_map
+        for name in sorted(attr_map):
+            print("Value: {0}={1!r}".format(name, attr_map[name].get()))
+
+class LinePattern(object):
+    """ A pattern matched at the start of single lines of a text, as if by
+    re.match on each line.  Candidate lines are found with one multiline
+    search over the text, then confirmed against the line alone. """
+
+    def __init__(self, pattern):
+        # Global inline flags such as (?i) must stay at the very start
+        flags = _INLINE_FLAGS_RE.match(pattern).group(0)
+        body = pattern[len(flags):]
+        if "x" in flags:
+            # End a trailing verbose-mode comment before the closing group
+            body += "\n"
+
+        self._match = re.compile(pattern).match
+        self._search = re.compile(flags + "^(?:" + body + ")", re.M).search
+
+    def find(self, data, pos=0, scan=None):
+        """ Return the (start, end) offsets of the first matching line at or
+        after pos, with end just past the line's newline, or None.  If given,
+        scan is a copy of data with each CRLF replaced by two LFs, which is
+        searched instead so that '$' also matches before a CRLF. """
+        if scan is None:
+            scan = data
+
+        size = len(data)
+        while pos < size:
+            # A pattern that can match an empty string also matches after
+            # the final newline, which is not a line of the text
+            match = self._search(scan, pos)
+            if match is None or match.start() >= size:
+                return None
+
+            start = match.start()
+            end = data.find("\n", start)
+            end = size if end < 0 else end + 1
+
+            # The search may run on past the end of the line, or start at
+            # the CR of a CRLF in scan, so confirm against the real line
+            # with its newline read as a plain LF
+            line = data[start:end]
+            if line.endswith("\r\n"):
+                line = line[:-2] + "\n"
+
+            if (start == 0 or data[start - 1] == "\n") and self._match(line):
+                return (start, end)
+
+            pos = end
+
+        return None
 
 class ConfigFileType(IniAttributeSection, DumpMixin):
     """ Represent the filetype """
@@ -166,8 +289,8 @@ class ConfigFileType(IniAttributeSection, DumpMixin):
         IniAttributeSection.__init__(self)
 
         self.extensions = IniListAttribute()
-        self.line_minlength = IniValueAttribute(80)
-        self.line_padding = IniValueAttribute(1)
+        self.line_minlength = IniIntAttribute(80)
+        self.line_padding = IniIntAttribute(1)
 
         self.firstline_start = IniValueAttribute("")
         self.firstline_end = IniValueAttribute("")
@@ -189,6 +312,8 @@ class ConfigFileType(IniAttributeSection, DumpMixin):
         self.midline_postpad = IniValueAttribute(" ")
         self.midline_center = IniBoolAttribute(False)
 
+        self._init_attr_map()
+
 
 class ConfigBlock(IniAttributeSection, DumpMixin):
     """ Represent a block. """
@@ -201,6 +326,25 @@ class ConfigBlock(IniAttributeSection, DumpMixin):
         self.start = IniValueAttribute("")
         self.end = IniValueAttribute("")
 
+        self._re_start = self._re_end = None
+
+        self._init_attr_map()
+
+    def compile(self):
+        """ Compile the start and end patterns. """
+        self._re_start = LinePattern(self.start_pattern.get())
+        self._re_end = LinePattern(self.end_pattern.get())
+
+    def re_start(self):
+        if self._re_start is None:
+            self.compile()
+        return self._re_start
+
+    def re_end(self):
+        if self._re_end is None:
+            self.compile()
+        return self._re_end
+
 class ConfigAction(IniAttributeSection, DumpMixin):
     """ Represent an action. """
 
@@ -211,6 +355,8 @@ class ConfigAction(IniAttributeSection, DumpMixin):
         self.text = IniValueAttribute("")
         self.block = IniValueAttribute("")
 
+        self._init_attr_map()
+
 class ConfigTextFiles(IniSection):
 
     def __init__(self):
@@ -225,33 +371,84 @@ class Config(object):
         self._actions = {}
         self._textblocks = ConfigTextFiles()
         self._textfiles = ConfigTextFiles()
+        self._textfile_dirs = {}
+        self._texts = {}
 
     def parse(self, filename):
-        config = configparser.ConfigParser()
-        config.read(filename)
+        config = _parse_ini(filename)
 
-        for section in config.sections():
+        for (section, items) in config.items():
             if section.startswith("filetype:"):
                 filetypename = section[9:]
                 if filetypename not in self._filetypes:
                     self._filetypes[filetypename] = ConfigFileType()
-                self._filetypes[filetypename].update(config.items(section))
+                self._filetypes[filetypename].update(items)
             elif section.startswith("block:"):
                 blockname = section[6:]
                 if blockname not in self._blocks:
                     self._blocks[blockname] = ConfigBlock()
-                self._blocks[blockname].update(config.items(section))
+                self._blocks[blockname].update(items)
+                self._blocks[blockname].compile()
             elif section.startswith("action:"):
                 actionname = section[7:]
                 if actionname not in self._actions:
                     self._actions[actionname] = ConfigAction()
-                self._actions[actionname].update(config.items(section))
+                self._actions[actionname].update(items)
             elif section == "text-blocks":
-                self._textblocks.update(config.items(section))
+                self._textblocks.update(items)
             elif section == "text-files":
-                self._textfiles.update(config.items(section))
+                # Text files are relative to the configuration file
+                self._textfiles.update(items)
+                self._textfile_dirs.update(
+                    (key, os.path.dirname(filename))
+                    for (key, value) in items
+                )
             else:
-                raise KeyError("Unknown section: {0}".format("section"))
+                raise KeyError("Unknown section: {0}".format(section))
+
+        self._check_actions()
+
+    def _check_actions(self):
+        """ Check that the filetypes, block and text named by each action exist. """
+        for (actionname, action) in self._actions.items():
+            for filetypename in action.filetype.get():
+                if filetypename not in self._filetypes:
+                    raise KeyError("Action {0}: unknown filetype: {1}".format(actionname, filetypename))
+
+            if action.block.get() not in self._blocks:
+                raise KeyError("Action {0}: unknown block: {1}".format(actionname, action.block.get()))
+
+            name = action.text.get().lower()
+            if self._textblocks.get(name) is None and self._textfiles.get(name) is None:
+                raise KeyError("Action {0}: unknown text: {1}".format(actionname, action.text.get()))
+
+    def text(self, name, encoding=DEFAULT_ENCODING):
+        """ Return the lines of a named text block or text file. """
+        # Names are lowercased when parsed, like all option names
+        name = name.lower()
+        if name not in self._texts:
+            value = self._textblocks.get(name)
+            if value is None:
+                path = self._textfiles.get(name)
+                if path is None:
+                    raise KeyError("Unknown text: {0}".format(name))
+
+                path = os.path.join(self._textfile_dirs[name], path)
+                with open(path, encoding=encoding) as handle:
+                    value = handle.read()
+
+            self._texts[name] = value.splitlines()
+
+        return self._texts[name]
+
+    def extension_map(self):
+        """ Return a mapping of lowercased extensions to filetype names. """
+        result = {}
+        for (name, filetype) in self._filetypes.items():
+            for ext in filetype.extensions.get():
+                result.setdefault(ext.lstrip(".").lower(), []).append(name)
+
+        return result
 
     def dump(self):
         for name in self._filetypes:
@@ -265,183 +462,240 @@ class Config(object):
             self._actions[name].dump()
 
 
-def determine_length(filetype, block, license):
+def _walk(root, exts):
+    """ Recursively yield the paths under root with an extension in exts. """
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                for path in _walk(entry.path, exts):
+                    yield path
+            else:
+                (_, dot, ext) = entry.name.rpartition(".")
+                if dot and ext.lower() in exts:
+                    yield entry.path
+
+def _read_text(path, encoding):
+    """ Read a file as text without translating its line endings.  Return
+    the text and the newline used by its first line. """
+    with open(path, "rb") as handle:
+        data = handle.read().decode(encoding)
+
+    end = data.find("\n")
+    newline = "\r\n" if end > 0 and data[end - 1] == "\r" else "\n"
+    return (data, newline)
+
+def apply_block(data, filetype, block, license, newline="\n"):
+    """ Replace each block in data, writing the new block with the given
+    newline.  Return the updated data and whether any block was found. """
+
+    re_start = block.re_start()
+    re_end = block.re_end()
+
+    # Same length as data, so offsets found in it apply to data as well
+    scan = data.replace("\r\n", "\n\n") if "\r\n" in data else data
+
+    outbuf = []
+    found = False
+    pos = 0
+    while True:
+        line = re_start.find(data, pos, scan)
+        if line is None:
+            break
+
+        # Drop the start line through the end line, or to the end of the data
+        # if the block is not closed, and put the new block in their place
+        outbuf.append(data[pos:line[0]])
+
+        line = re_end.find(data, line[1], scan)
+        pos = len(data) if line is None else line[1]
+
+        outbuf.append(generate_block(filetype, block, license, newline))
+        found = True
+
+    outbuf.append(data[pos:])
+    return ("".join(outbuf), found)
+
+def generate_block(filetype, block, license, newline="\n"):
+    parts = []
+
+    fl_start = filetype.firstline_start.get()
+    fl_end = filetype.firstline_end.get()
+    fl_prepad = filetype.firstline_prepad.get()
+    fl_postpad = filetype.firstline_postpad.get()
+    fl_filler = filetype.firstline_filler.get()
+    fl_center = filetype.firstline_center.get()
+
+    ml_start = filetype.midline_start.get()
+    ml_end = filetype.midline_end.get()
+    ml_center = filetype.midline_center.get()
+    ml_prefix_len = len(ml_start) + len(ml_end)
+    ml_has_end = len(ml_end) > 0
+
+    ll_start = filetype.lastline_start.get()
+    ll_end = filetype.lastline_end.get()
+    ll_prepad = filetype.lastline_prepad.get()
+    ll_postpad = filetype.lastline_postpad.get()
+    ll_filler = filetype.lastline_filler.get()
+    ll_center = filetype.lastline_center.get()
+
+    pad_count = filetype.line_padding.get()
+    blk_start = block.start.get()
+    blk_end = block.end.get()
+
+    # Determine the length from the longest line
+    firstline_len = len(fl_start) + len(fl_prepad) + len(blk_start) + len(fl_postpad) + len(fl_end)
+    lastline_len = len(ll_start) + len(ll_prepad) + len(blk_end) + len(ll_postpad) + len(ll_end)
+    midline_len = ml_prefix_len + max(map(len, license))
+    length = max(firstline_len, midline_len, lastline_len, filetype.line_minlength.get())
 
     # First line
-    firstline_len = (
-        len(filetype.firstline_start.get()) +
-        len(filetype.firstline_end.get()) +
-        len(filetype.firstline_prepad.get()) + 
-        len(filetype.firstline_postpad.get()) +
-        len(block.start.get())
-    )
+    lead_pad = trail_pad = ""
+    if firstline_len < length:
+        char = fl_filler[0]
+        filler = length - firstline_len
+        part = filler >> 1 if fl_center else 0
 
-    # Last line
-    lastline_len = (
-        len(filetype.lastline_start.get()) +
-        len(filetype.lastline_end.get()) +
-        len(filetype.lastline_prepad.get()) + 
-        len(filetype.lastline_postpad.get()) +
-        len(block.end.get())
-    )
+        lead_pad = char * part
+        trail_pad = char * (filler - part)
 
-    # Middle lines
-    liclen = max(len(line) for line in license) # Find largest line
-    midline_len = (
-        len(filetype.midline_start.get()) +
-        len(filetype.midline_end.get()) +
-        liclen
-    )
-
-    return max(firstline_len, midline_len, lastline_len, int(filetype.line_minlength.get()))
-
-def apply_block(handle, filetype, block, license):
-    # Apply to a file
-
-    re_start = re.compile(block.start_pattern.get())
-    re_end = re.compile(block.end_pattern.get())
-
-    in_block = False
-    for line in handle:
-        if in_block:
-            # Consume until we are out of the block
-            if re_end.match(line):
-                in_block = False
-                generate_block(filetype, block, license)
-
-            continue
-        
-        if re_start.match(line):
-            in_block = True
-            continue
-
-        print(line, end="")
-    if in_block:
-        # Ended in the block
-        generate_block(filetype, block, license)
-
-def generate_block(filetype, block, license):
-    length = determine_length(filetype, block, license)
-
-    # First line
-    firstline = [
-        filetype.firstline_start.get(),
-        "",
-        filetype.firstline_prepad.get(),
-        block.start.get(),
-        filetype.firstline_postpad.get(),
-        "",
-        filetype.firstline_end.get()
-    ]
-
-    total = sum(len(part) for part in firstline)
-    if total < length:
-        char = filetype.firstline_filler.get()[0]
-        filler = length - total
-
-        if filetype.firstline_center.get():
-            part = filler / 2
-            firstline[1] = char * part
-            filler -= part
-
-        if filler > 0:
-            firstline[5] = char * filler
-            
-    firstline = "".join(firstline)
-    print(firstline)
+    firstline = fl_start + lead_pad + fl_prepad + blk_start + fl_postpad + trail_pad + fl_end
+    parts.append(firstline + newline)
 
     # Line padding
-    padline = [
-        filetype.midline_start.get(),
-        "",
-        filetype.midline_end.get()
-    ]
-
-    total = sum(len(part) for part in padline)
-    if total < length and len(padline[2]):
-        padline[1] = " " * (length - total)
-    padline = "".join(padline)
+    padline = ml_start + ml_end
+    if ml_prefix_len < length and ml_has_end:
+        padline = ml_start + " " * (length - ml_prefix_len) + ml_end
 
-    for i in range(int(filetype.line_padding.get())):
-        print(padline)
+    pad_block = (padline + newline) * pad_count
+    parts.append(pad_block)
 
 
     # Middle lines
-    midline = [
-        filetype.midline_start.get(),
-        "",
-        "",
-        "",
-        filetype.midline_end.get()
-    ]
-
     for line in license:
-        # reset padding area
-        midline[1] = midline[3] = ""
-        midline[2] = line
+        lead_pad = trail_pad = ""
 
         # Only need adjusting if centering or have an ending
-        if len(midline[4]) or filetype.midline_center.get():
-            total = sum(len(part) for part in midline)
-            if total < length:
-                filler = length - total
-                if filetype.midline_center.get() and (len(midline[4]) or len(midline[2])):
-                    part = filler / 2
-                    midline[1] = " " * part
+        if ml_has_end or ml_center:
+            filler = length - ml_prefix_len - len(line)
+            if filler > 0:
+                if ml_center and (ml_has_end or line):
+                    part = filler >> 1
+                    lead_pad = " " * part
                     filler -= part
 
                 # Only add ending space if there is an ending
-                if filler > 0 and len(midline[4]):
-                    midline[3] = " " * filler
+                if filler > 0 and ml_has_end:
+                    trail_pad = " " * filler
 
-        line = "".join(midline)
-        print(line)
+        parts.append(ml_start + lead_pad + line + trail_pad + ml_end + newline)
            
     # Line padding
-
-    for i in range(int(filetype.line_padding.get())):
-        print(padline)
+    parts.append(pad_block)
 
     # Last line
-    lastline = [
-        filetype.lastline_start.get(),
-        "",
-        filetype.lastline_prepad.get(),
-        block.end.get(),
-        filetype.lastline_postpad.get(),
-        "",
-        filetype.lastline_end.get()
-    ]
-
-    total = sum(len(part) for part in lastline)
-    if total < length:
-        char = filetype.lastline_filler.get()[0]
-        filler = length - total
-
-        if filetype.lastline_center.get():
-            part = filler / 2
-            lastline[1] = char * part
-            filler -= part
-
-        if filler > 0:
-            lastline[5] = char * filler
-            
-    lastline = "".join(lastline)
-    print(lastline)
-
-        
-c = Config()
-c.parse("config.ini")
-#c.dump()
-
-test_license = [
-    "Stop: This is a test license dddddddddddddddddddddddddddddddddddddddddddddddddddddddddddddddd",
-    "",
-    "1) Don't claim credit",
-    "2) Don't share freely",
-    "3) Feed me!"
-]
-
-with open("test.txt") as handle:
-    apply_block(handle, c._filetypes["c"], c._blocks["license-c"], test_license)
-
+    lead_pad = trail_pad = ""
+    if lastline_len < length:
+        char = ll_filler[0]
+        filler = length - lastline_len
+        part = filler >> 1 if ll_center else 0
+
+        lead_pad = char * part
+        trail_pad = char * (filler - part)
+
+    lastline = ll_start + lead_pad + ll_prepad + blk_end + ll_postpad + trail_pad + ll_end
+    parts.append(lastline + newline)
+
+    return "".join(parts)
+
+_worker_config = None
+
+def _init_worker(filename):
+    """ Load the configuration once in each worker process. """
+    global _worker_config
+    _worker_config = Config()
+    _worker_config.parse(filename)
+
+def apply_block_to_path(job):
+    """ Apply each (filetype, action) name pair of a job to its file.  Return
+    a (path, output, error) tuple.  The output is the updated contents, or
+    None if the file is updated in place, and error is a message if the file
+    could not be processed. """
+    (path, actions, in_place, encoding) = job
+    config = _worker_config
+
+    try:
+        (data, newline) = _read_text(path, encoding)
+
+        changed = False
+        for (filetypename, actionname) in actions:
+            action = config._actions[actionname]
+            (data, found) = apply_block(
+                data,
+                config._filetypes[filetypename],
+                config._blocks[action.block.get()],
+                config.text(action.text.get(), encoding),
+                newline
+            )
+            changed = changed or found
+
+        data = data.encode(encoding)
+        if not in_place:
+            return (path, data, None)
+
+        if changed:
+            with open(path, "wb") as handle:
+                handle.write(data)
+    except Exception as e:
+        # Report the failure and let the other files carry on
+        return (path, None, "{0}: {1}".format(type(e).__name__, e))
+
+    return (path, None, None)
+
+def main():
+    parser = argparse.ArgumentParser(description="Update blocks of text in files.")
+    parser.add_argument("-c", "--config", default="config.ini",
+                        help="configuration file (default: config.ini)")
+    parser.add_argument("-i", "--in-place", action="store_true",
+                        help="update the files instead of printing them")
+    parser.add_argument("-e", "--encoding", default=DEFAULT_ENCODING,
+                        help="encoding of the files (default: {0})".format(DEFAULT_ENCODING))
+    parser.add_argument("root", nargs="?", default=".",
+                        help="directory to scan (default: .)")
+    args = parser.parse_args()
+
+    c = Config()
+    c.parse(args.config)
+    #c.dump()
+
+    # One job per file so no two workers write the same file
+    jobs = []
+    extmap = c.extension_map()
+    for path in _walk(args.root, frozenset(extmap)):
+        ext = path.rpartition(".")[2].lower()
+        actions = [
+            (filetypename, actionname)
+            for filetypename in extmap[ext]
+            for (actionname, action) in c._actions.items()
+            if filetypename in action.filetype.get()
+        ]
+        if actions:
+            jobs.append((path, actions, args.in_place, args.encoding))
+
+    failed = 0
+    with ProcessPoolExecutor(initializer=_init_worker, initargs=(args.config,)) as executor:
+        for (path, output, error) in executor.map(apply_block_to_path, jobs, chunksize=32):
+            if error is not None:
+                failed += 1
+                sys.stdout.flush()
+                print("{0}: {1}".format(path, error), file=sys.stderr)
+            elif output is not None:
+                sys.stdout.buffer.write(output)
+
+    if failed:
+        print("{0} of {1} files failed".format(failed, len(jobs)), file=sys.stderr)
+        return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())